@@ -1,6 +1,11 @@
 import asyncio
-import io
-import json
+import base64
+import collections
+import concurrent.futures
+import hashlib
+import multiprocessing
+import os
+import random
 import time
 
 from fastapi import FastAPI
@@ -22,11 +27,288 @@ from common_code.common.models import FieldDescription, ExecutionUnitTag
 from contextlib import asynccontextmanager
 
 # Imports required by the service's model
-import requests
-from pydub import AudioSegment
+import httpx
+import orjson
+from cachetools import TTLCache
+from prometheus_client import Counter, Gauge, Histogram, make_asgi_app
+from transcode import transcode_to_ogg
 
 settings = get_settings()
 
+# Maximum number of queries sent to Hugging Face at the same time
+HF_MAX_INFLIGHT = 32
+# Number of seconds to connect to Hugging Face and to receive a response
+HF_CONNECT_TIMEOUT = 5
+HF_READ_TIMEOUT = 120
+# Number of seconds a query waits for a free slot before failing
+HF_ACQUIRE_TIMEOUT = 30
+# Inference API host connected to at startup so the first queries skip the DNS lookup and TLS handshake
+HF_INFERENCE_API_URL = "https://api-inference.huggingface.co"
+# Whether to connect to the inference API at startup, disabled by the tests
+HF_WARM_UP = True
+# Number of seconds an announcement to an engine may take before being retried
+ENGINE_ANNOUNCE_TIMEOUT = 30
+# Share of the Hugging Face slots in use above which the service reports itself as saturated
+HF_SATURATION_THRESHOLD = 0.8
+# Number of times a query is retried while the model is loading on Hugging Face
+HF_LOADING_RETRIES = 3
+# Maximum number of seconds waited between two retries while the model is loading
+HF_LOADING_MAX_DELAY = 20
+# Maximum number of generated audios kept in memory and number of seconds they are kept
+AUDIO_CACHE_SIZE = 512
+AUDIO_CACHE_TTL = 3600
+# Maximum number of models remembered as not supporting batched queries
+UNBATCHABLE_MODELS_SIZE = 256
+# Maximum number of decoded json_description kept in memory
+CREDENTIALS_CACHE_SIZE = 16
+# Number of seconds left to transcode the audio once it has been generated
+TRANSCODE_TIMEOUT = 60
+# Number of seconds a chain of loading retries may take: each attempt waits for a slot, the response and the backoff
+HF_RETRIES_TIMEOUT = (
+    (HF_LOADING_RETRIES + 1) * (HF_ACQUIRE_TIMEOUT + HF_CONNECT_TIMEOUT + HF_READ_TIMEOUT)
+    + HF_LOADING_RETRIES * (HF_LOADING_MAX_DELAY + 1)
+)
+# Number of seconds a task may take: a batched query may run a chain of retries then fall back
+# to one query per input, each running its own chain concurrently
+PROCESS_TIMEOUT = 2 * HF_RETRIES_TIMEOUT + TRANSCODE_TIMEOUT
+
+# Metrics exposed on /metrics
+hf_inflight = Gauge("hf_inflight", "Number of queries in progress on Hugging Face")
+hf_saturated = Gauge("hf_saturated", "Whether the queries in progress on Hugging Face exceed the saturation threshold")
+hf_semaphore_wait_seconds = Histogram("hf_semaphore_wait_seconds", "Time spent waiting for a Hugging Face slot")
+hf_upstream_seconds = Histogram("hf_upstream_seconds", "Duration of the Hugging Face queries")
+transcode_seconds = Histogram("transcode_seconds", "Duration of the audio transcodes to OGG")
+hf_errors_total = Counter("hf_errors_total", "Number of failed Hugging Face queries", ["reason"])
+hf_loading_retries_total = Counter("hf_loading_retries_total", "Number of queries retried while the model was loading")
+
+
+class TextToAudioBatcher:
+    """
+    Coalesces the queries sent concurrently to the same Hugging Face model into a single request
+
+    The queries already waiting are dispatched right away, `max_delay` optionally keeps the batch
+    open a little longer for more queries to join it. Queries can only be batched when several tasks
+    are processed at the same time: with a tasks service processing one task at a time, every batch
+    holds a single query and is sent as a plain query.
+    """
+
+    def __init__(
+        self,
+        client: httpx.AsyncClient,
+        semaphore: asyncio.Semaphore,
+        capacity: int,
+        max_batch_size: int = 8,
+        max_delay: float = 0,
+    ):
+        self._client = client
+        self._semaphore = semaphore
+        # Number of slots of the semaphore, the saturation is reported relative to it
+        self._capacity = capacity
+        self._max_batch_size = max_batch_size
+        self._max_delay = max_delay
+        self._queue = asyncio.Queue()
+        self._server_task = None
+        self._batch_tasks = set()
+        self._inflight = 0
+        # Models that didn't answer a batched query with a list of audios, they are queried one input at a time
+        self._unbatchable_urls = collections.OrderedDict()
+
+    def start(self):
+        self._server_task = asyncio.ensure_future(self._server_loop())
+
+    async def stop(self):
+        self._server_task.cancel()
+        for task in self._batch_tasks:
+            task.cancel()
+        await asyncio.gather(self._server_task, *self._batch_tasks, return_exceptions=True)
+
+        # Fail the queries not dispatched yet so their callers don't wait forever
+        while not self._queue.empty():
+            self._fail([self._queue.get_nowait()], self._stopped_error())
+
+    @staticmethod
+    def _stopped_error():
+        return Exception("The service is shutting down, the query was cancelled")
+
+    @staticmethod
+    def _fail(items, err):
+        for _, _, _, future in items:
+            if not future.done():
+                future.set_exception(err)
+
+    async def query(self, api_url, headers, text):
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((api_url, headers, text, future))
+        return await future
+
+    async def _server_loop(self):
+        loop = asyncio.get_running_loop()
+        pending = []
+        try:
+            while True:
+                pending = [await self._queue.get()]
+                while len(pending) < self._max_batch_size and not self._queue.empty():
+                    pending.append(self._queue.get_nowait())
+
+                deadline = loop.time() + self._max_delay
+                while len(pending) < self._max_batch_size:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        pending.append(await asyncio.wait_for(self._queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+
+                # Only the queries sent to the same model with the same token can share a request
+                batches = {}
+                for item in pending:
+                    api_url, headers, _, _ = item
+                    batches.setdefault((api_url, headers["Authorization"]), []).append(item)
+
+                for items in batches.values():
+                    task = asyncio.ensure_future(self._run_batch(items))
+                    self._batch_tasks.add(task)
+                    task.add_done_callback(self._batch_tasks.discard)
+                pending = []
+        except asyncio.CancelledError:
+            self._fail(pending, self._stopped_error())
+            raise
+
+    async def _run_batch(self, items):
+        api_url, headers, _, _ = items[0]
+        texts = [text for _, _, text, _ in items]
+
+        try:
+            if len(texts) == 1:
+                results = [(await self._post(api_url, headers, texts[0])).content]
+            elif api_url in self._unbatchable_urls:
+                self._unbatchable_urls.move_to_end(api_url)
+                results = await self._post_each(api_url, headers, texts)
+            else:
+                results = await self._post_batch(api_url, headers, texts)
+        except asyncio.CancelledError:
+            self._fail(items, self._stopped_error())
+            raise
+        except Exception as err:
+            self._fail(items, err)
+            return
+
+        # Each query gets its own audio or error, the queries of a batch may come from different tasks
+        for (_, _, _, future), result in zip(items, results):
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def _post(self, api_url, headers, inputs):
+        # The model is loaded on Hugging Face's side on first use, wait for it instead of failing the query
+        for attempt in range(HF_LOADING_RETRIES + 1):
+            response = await self._send(api_url, headers, inputs)
+            loading_time = self._get_loading_time(response)
+            if loading_time is None or attempt == HF_LOADING_RETRIES:
+                # Counted once per response, even when it is shared by all the queries of a batch
+                if not response.is_success:
+                    hf_errors_total.labels(reason="upstream").inc()
+                    # JSON errors are reported by the service, anything else would reach the transcode
+                    if response.content[:1] != b"{":
+                        raise Exception(f"Hugging Face answered with HTTP {response.status_code}")
+                return response
+
+            hf_loading_retries_total.inc()
+            # Back off exponentially when Hugging Face doesn't give an estimated loading time
+            delay = min(loading_time or 2 ** attempt, HF_LOADING_MAX_DELAY)
+            await asyncio.sleep(delay + random.random())
+
+    @staticmethod
+    def _get_loading_time(response):
+        """
+        Return the estimated loading time of the model if it is currently loading (0 if unknown), None otherwise
+        """
+        # Other errors, such as a gateway page, are not worth retrying
+        if response.content[:1] != b"{":
+            return None
+        try:
+            json_data = orjson.loads(response.content)
+        except ValueError:
+            return None
+        if not isinstance(json_data, dict):
+            return None
+
+        is_loading = "currently loading" in str(json_data.get("error", ""))
+        if not is_loading and not (response.status_code == 503 and "estimated_time" in json_data):
+            return None
+
+        try:
+            return float(json_data.get("estimated_time") or 0)
+        except (TypeError, ValueError):
+            return 0.0
+
+    async def _send(self, api_url, headers, inputs):
+        # Fail fast rather than piling up queries when Hugging Face can't keep up
+        wait_start = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), HF_ACQUIRE_TIMEOUT)
+        except asyncio.TimeoutError:
+            hf_errors_total.labels(reason="saturated").inc()
+            raise Exception("Too many queries in progress on Hugging Face, try again later")
+        finally:
+            hf_semaphore_wait_seconds.observe(time.perf_counter() - wait_start)
+
+        self._inflight += 1
+        self._report_inflight()
+        try:
+            with hf_upstream_seconds.time():
+                response = await self._client.post(
+                    api_url, headers=headers, content=orjson.dumps({"inputs": inputs})
+                )
+        except httpx.HTTPError:
+            hf_errors_total.labels(reason="request").inc()
+            raise
+        finally:
+            self._semaphore.release()
+            self._inflight -= 1
+            self._report_inflight()
+        return response
+
+    def _report_inflight(self):
+        hf_inflight.set(self._inflight)
+        hf_saturated.set(self._inflight > HF_SATURATION_THRESHOLD * self._capacity)
+
+    async def _post_batch(self, api_url, headers, texts):
+        response = await self._post(api_url, headers, texts)
+
+        # The model is still loading after the retries or answered with an error (invalid token...),
+        # querying each input would only get the same answer
+        if self._get_loading_time(response) is not None or not response.is_success:
+            return [response.content] * len(texts)
+
+        result_data = response.content
+
+        # A batched query returns the audio of each input base64 encoded in a JSON list
+        try:
+            results = orjson.loads(result_data)
+            if isinstance(results, list) and len(results) == len(texts):
+                return [base64.b64decode(result) for result in results]
+        except (ValueError, TypeError):
+            pass
+
+        # The model doesn't support batched inputs, fall back to one request per input from now on
+        self._unbatchable_urls[api_url] = True
+        if len(self._unbatchable_urls) > UNBATCHABLE_MODELS_SIZE:
+            self._unbatchable_urls.popitem(last=False)
+        return await self._post_each(api_url, headers, texts)
+
+    async def _post_each(self, api_url, headers, texts):
+        responses = await asyncio.gather(
+            *[self._post(api_url, headers, text) for text in texts], return_exceptions=True
+        )
+        return [
+            response if isinstance(response, BaseException) else response.content for response in responses
+        ]
+
 
 class MyService(Service):
     """
@@ -36,6 +318,9 @@ class MyService(Service):
     # Any additional fields must be excluded for Pydantic to work
     _model: object
     _logger: Logger
+    _loop: asyncio.AbstractEventLoop
+    _cache: TTLCache
+    _credentials_cache: collections.OrderedDict
 
     def __init__(self):
         super().__init__(
@@ -78,45 +363,82 @@ class MyService(Service):
             docs_url="https://docs.swiss-ai-center.ch/reference/services/hugging-face-text-to-audio/",
         )
         self._logger = get_logger(settings)
+        # The service is created in the lifespan, on the event loop running the Hugging Face client
+        self._loop = asyncio.get_running_loop()
+        # Generated audios by query, only accessed from the event loop
+        self._cache = TTLCache(maxsize=AUDIO_CACHE_SIZE, ttl=AUDIO_CACHE_TTL)
+        # Decoded json_description by raw content, the same one is sent with every task
+        self._credentials_cache = collections.OrderedDict()
 
     def process(self, data):
+        # The tasks service calls `process` from its worker, the Hugging Face client
+        # lives on the application's event loop so the query is scheduled there
+        future = asyncio.run_coroutine_threadsafe(self._process(data), self._loop)
+        try:
+            return future.result(timeout=PROCESS_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise Exception(f"The query to Hugging Face timed out after {PROCESS_TIMEOUT} seconds")
+
+    def _get_credentials(self, json_description_data):
+        credentials = self._credentials_cache.get(json_description_data)
+        if credentials is not None:
+            self._credentials_cache.move_to_end(json_description_data)
+            return credentials
 
         try:
-            json_description = json.loads(data['json_description'].data.decode('utf-8'))
+            json_description = orjson.loads(json_description_data)
             api_token = json_description['api_token']
             api_url = json_description['api_url']
         except ValueError as err:
             raise Exception(f"json_description is invalid: {str(err)}")
         except KeyError as err:
             raise Exception(f"api_url or api_token missing from json_description: {str(err)}")
-        headers = {"Authorization": f"Bearer {api_token}"}
+        headers = {"Authorization": f"Bearer {api_token}", "Content-Type": "application/json"}
 
-        def is_valid_json(json_string):
-            try:
-                json.loads(json_string)
-                return True
-            except ValueError:
-                return False
+        credentials = (api_url, api_token, headers)
+        self._credentials_cache[json_description_data] = credentials
+        if len(self._credentials_cache) > CREDENTIALS_CACHE_SIZE:
+            self._credentials_cache.popitem(last=False)
+        return credentials
 
-        def text_to_audio_query(payload):
-            response = requests.post(api_url, headers=headers, json=payload)
-            return response.content
+    async def _process(self, data):
+        api_url, api_token, headers = self._get_credentials(bytes(data['json_description'].data))
 
         input_text_bytes = data['input_text'].data
-        json_input_text = f'{{ "inputs" : "{input_text_bytes.decode("utf-8")}" }}'
-        json_payload = json.loads(json_input_text)
-        result_data = text_to_audio_query(json_payload)
-
-        if is_valid_json(result_data):
-            json_data = json.loads(result_data)
+        cache_key = hashlib.blake2b(
+            b"\0".join([api_url.encode(), api_token.encode(), input_text_bytes]), digest_size=16
+        ).digest()
+        ogg_data = self._cache.get(cache_key)
+        if ogg_data is not None:
+            return {
+                "result": TaskData(data=ogg_data, type=FieldDescriptionType.AUDIO_OGG)
+            }
+
+        result_data = await app.state.hf_batcher.query(api_url, headers, input_text_bytes.decode('utf-8'))
+
+        # Audio files never start with `{`, only errors have to be parsed
+        if result_data[:1] == b"{":
+            try:
+                json_data = orjson.loads(result_data)
+            except ValueError:
+                json_data = {}
             if 'error' in json_data:
                 self._logger.error(json_data['error'])
                 raise Exception(json_data['error'])
 
-        audio_segment = AudioSegment.from_file(io.BytesIO(result_data))
+        # The model may already return an OGG file, only other containers (WAV, FLAC...) are transcoded
+        if result_data[:4] == b"OggS":
+            ogg_data = result_data
+        else:
+            with transcode_seconds.time():
+                ogg_data = await asyncio.get_running_loop().run_in_executor(
+                    app.state.transcode_pool, transcode_to_ogg, result_data
+                )
+
+        self._cache[cache_key] = ogg_data
         return {
-            "result": TaskData(data=audio_segment.export(format='ogg').read(),
-                               type=FieldDescriptionType.AUDIO_OGG)
+            "result": TaskData(data=ogg_data, type=FieldDescriptionType.AUDIO_OGG)
         }
 
 
@@ -134,6 +456,20 @@ async def lifespan(app: FastAPI):
 
     # Startup
     logger = get_logger(settings)
+    # Keep the connections to the inference API alive between queries to avoid a TLS handshake each time
+    app.state.hf_client = httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(HF_READ_TIMEOUT, connect=HF_CONNECT_TIMEOUT),
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=50, keepalive_expiry=60),
+    )
+    # Spawn the workers rather than forking the service with its threads, connections and cache
+    app.state.transcode_pool = concurrent.futures.ProcessPoolExecutor(
+        max_workers=os.cpu_count(),
+        mp_context=multiprocessing.get_context("spawn"),
+    )
+    app.state.hf_sem = asyncio.Semaphore(HF_MAX_INFLIGHT)
+    app.state.hf_batcher = TextToAudioBatcher(app.state.hf_client, app.state.hf_sem, HF_MAX_INFLIGHT)
+    app.state.hf_batcher.start()
     http_client = HttpClient()
     storage_service = StorageService(logger)
     my_service = MyService()
@@ -145,29 +481,64 @@ async def lifespan(app: FastAPI):
     # Start the tasks service
     tasks_service.start()
 
-    async def announce():
+    async def warm_up():
+        try:
+            await app.state.hf_client.head(HF_INFERENCE_API_URL)
+        except httpx.HTTPError as err:
+            logger.info(f"Unable to warm up the connection to {HF_INFERENCE_API_URL}: {str(err)}")
+
+    # Open a connection to the inference API before the first query
+    warm_up_task = asyncio.ensure_future(warm_up()) if HF_WARM_UP else None
+
+    async def announce_one(engine_url):
         retries = settings.engine_announce_retries
-        for engine_url in settings.engine_urls:
-            announced = False
-            while not announced and retries > 0:
-                announced = await service_service.announce_service(my_service, engine_url)
-                retries -= 1
-                if not announced:
-                    time.sleep(settings.engine_announce_retry_delay)
-                    if retries == 0:
-                        logger.warning(
-                            f"Aborting service announcement after "
-                            f"{settings.engine_announce_retries} retries"
-                        )
-
-    # Announce the service to its engine
+        announced = False
+        while not announced and retries > 0:
+            try:
+                announced = await asyncio.wait_for(
+                    service_service.announce_service(my_service, engine_url),
+                    ENGINE_ANNOUNCE_TIMEOUT,
+                )
+            except asyncio.TimeoutError:
+                logger.warning(f"Announcement to {engine_url} timed out")
+                announced = False
+            retries -= 1
+            if not announced:
+                await asyncio.sleep(settings.engine_announce_retry_delay)
+                if retries == 0:
+                    logger.warning(
+                        f"Aborting service announcement to {engine_url} after "
+                        f"{settings.engine_announce_retries} retries"
+                    )
+
+    async def announce():
+        results = await asyncio.gather(
+            *[announce_one(engine_url) for engine_url in settings.engine_urls], return_exceptions=True
+        )
+        for engine_url, result in zip(settings.engine_urls, results):
+            if isinstance(result, Exception):
+                logger.error(f"Unable to announce the service to {engine_url}: {str(result)}")
+
+    # Announce the service to its engines
     asyncio.ensure_future(announce())
 
     yield
 
     # Shutdown
-    for engine_url in settings.engine_urls:
-        await service_service.graceful_shutdown(my_service, engine_url)
+    results = await asyncio.gather(
+        *[service_service.graceful_shutdown(my_service, engine_url) for engine_url in settings.engine_urls],
+        return_exceptions=True,
+    )
+    for engine_url, result in zip(settings.engine_urls, results):
+        if isinstance(result, Exception):
+            logger.error(f"Unable to shut down gracefully from {engine_url}: {str(result)}")
+
+    if warm_up_task is not None:
+        warm_up_task.cancel()
+        await asyncio.gather(warm_up_task, return_exceptions=True)
+    await app.state.hf_batcher.stop()
+    await app.state.hf_client.aclose()
+    await asyncio.get_running_loop().run_in_executor(None, app.state.transcode_pool.shutdown)
 
 
 api_description = """The service is used to query text-to-audio AI models from the Hugging Face inference API.\n
@@ -204,7 +575,8 @@ It must have the following input structure (json):
  liquid drum and bass, atmospheric synths, airy sounds
  ```
 
- The model may need some time to load on Hugging face's side, you may encounter an error on your first try.
+ The model may need some time to load on Hugging face's side, the service waits and retries a few times while the
+ model is loading. If the model still isn't loaded after that, you may encounter an error: try again later.
 
  Helpful trick: The answer from the inference API is cached, so if you encounter a loading error try to change the
  input to check if the model is loaded.
@@ -247,6 +619,10 @@ app.add_middleware(
 )
 
 
+# Expose the metrics to Prometheus
+app.mount("/metrics", make_asgi_app())
+
+
 # Redirect to docs
 @app.get("/", include_in_schema=False)
 async def root():
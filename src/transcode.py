@@ -0,0 +1,12 @@
+import io
+
+from pydub import AudioSegment
+
+
+def transcode_to_ogg(audio_data: bytes) -> bytes:
+    # Runs in the transcode process pool, ffmpeg is CPU bound and would block the event loop.
+    # Kept out of main so the spawned workers don't import the whole service
+    audio_segment = AudioSegment.from_file(io.BytesIO(audio_data))
+    ogg_buffer = io.BytesIO()
+    audio_segment.export(ogg_buffer, format='ogg')
+    return ogg_buffer.getvalue()
@@ -0,0 +1,8 @@
+import pytest
+import main
+
+
+@pytest.fixture(autouse=True)
+def disable_warm_up(monkeypatch: pytest.MonkeyPatch):
+    # The tests must not connect to the real inference API
+    monkeypatch.setattr(main, "HF_WARM_UP", False)
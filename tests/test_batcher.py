@@ -0,0 +1,293 @@
+import asyncio
+import base64
+import httpx
+import orjson
+import pytest
+from prometheus_client import REGISTRY
+import main
+from main import HF_LOADING_MAX_DELAY, HF_LOADING_RETRIES, TextToAudioBatcher
+
+API_URL = "https://api-inference.huggingface.co/models/test"
+OTHER_API_URL = "https://api-inference.huggingface.co/models/other"
+HEADERS = {"Authorization": "Bearer token", "Content-Type": "application/json"}
+
+
+def audio_for(text):
+    return f"audio of {text}".encode()
+
+
+def make_batcher(handler, semaphore=None, capacity=4, **kwargs):
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    batcher = TextToAudioBatcher(client, semaphore or asyncio.Semaphore(capacity), capacity, **kwargs)
+    batcher.start()
+    return batcher, client
+
+
+async def close(batcher, client):
+    await batcher.stop()
+    await client.aclose()
+
+
+async def query_all(batcher, queries):
+    return await asyncio.gather(
+        *[batcher.query(api_url, HEADERS, text) for api_url, text in queries], return_exceptions=True
+    )
+
+
+@pytest.mark.asyncio
+async def test_single_query():
+    sent = []
+
+    def handler(request):
+        inputs = orjson.loads(request.content)["inputs"]
+        sent.append(inputs)
+        return httpx.Response(200, content=audio_for(inputs))
+
+    batcher, client = make_batcher(handler)
+    result = await batcher.query(API_URL, HEADERS, "drums")
+    await close(batcher, client)
+
+    assert result == audio_for("drums")
+    assert sent == ["drums"]
+
+
+@pytest.mark.asyncio
+async def test_batched_queries():
+    sent = []
+
+    def handler(request):
+        inputs = orjson.loads(request.content)["inputs"]
+        sent.append((str(request.url), inputs))
+        if isinstance(inputs, list):
+            return httpx.Response(200, json=[base64.b64encode(audio_for(text)).decode() for text in inputs])
+        return httpx.Response(200, content=audio_for(inputs))
+
+    batcher, client = make_batcher(handler, max_delay=0.05)
+    results = await query_all(batcher, [(API_URL, "drums"), (API_URL, "bass"), (OTHER_API_URL, "piano")])
+    await close(batcher, client)
+
+    assert results == [audio_for("drums"), audio_for("bass"), audio_for("piano")]
+    # The queries to different models are never sent together
+    assert sorted(sent) == [(OTHER_API_URL, "piano"), (API_URL, ["drums", "bass"])]
+
+
+@pytest.mark.asyncio
+async def test_batched_queries_fallback():
+    sent = []
+
+    def handler(request):
+        inputs = orjson.loads(request.content)["inputs"]
+        sent.append(inputs)
+        # The model ignores the list and generates a single audio
+        return httpx.Response(200, content=audio_for(str(inputs)))
+
+    batcher, client = make_batcher(handler, max_delay=0.05)
+    results = await query_all(batcher, [(API_URL, "drums"), (API_URL, "bass")])
+    assert results == [audio_for("drums"), audio_for("bass")]
+    assert sent[0] == ["drums", "bass"]
+    assert sorted(sent[1:]) == ["bass", "drums"]
+
+    # The model is remembered as not supporting batched queries
+    sent.clear()
+    results = await query_all(batcher, [(API_URL, "piano"), (API_URL, "guitar")])
+    await close(batcher, client)
+
+    assert results == [audio_for("piano"), audio_for("guitar")]
+    assert sorted(sent) == ["guitar", "piano"]
+
+
+@pytest.mark.asyncio
+async def test_batched_queries_fallback_partial_failure():
+    def handler(request):
+        inputs = orjson.loads(request.content)["inputs"]
+        if isinstance(inputs, list):
+            return httpx.Response(200, content=audio_for(str(inputs)))
+        if inputs == "bad":
+            return httpx.Response(502, content=b"Bad Gateway")
+        return httpx.Response(200, content=audio_for(inputs))
+
+    batcher, client = make_batcher(handler, max_delay=0.05)
+    results = await query_all(batcher, [(API_URL, "drums"), (API_URL, "bad"), (API_URL, "bass")])
+    await close(batcher, client)
+
+    # Only the failing input fails, the other queries of the batch keep their audio
+    assert results[0] == audio_for("drums")
+    assert isinstance(results[1], Exception) and "HTTP 502" in str(results[1])
+    assert results[2] == audio_for("bass")
+
+
+@pytest.mark.asyncio
+async def test_batched_queries_error_not_retried_per_input():
+    sent = []
+
+    def handler(request):
+        sent.append(orjson.loads(request.content)["inputs"])
+        return httpx.Response(401, json={"error": "Invalid credentials in Authorization header"})
+
+    batcher, client = make_batcher(handler, max_delay=0.05)
+    results = await query_all(batcher, [(API_URL, "drums"), (API_URL, "bass")])
+    assert all(b"Invalid credentials" in result for result in results)
+    assert sent == [["drums", "bass"]]
+
+    # The model isn't remembered as unbatchable
+    sent.clear()
+    await query_all(batcher, [(API_URL, "piano"), (API_URL, "guitar")])
+    await close(batcher, client)
+
+    assert sent == [["piano", "guitar"]]
+
+
+@pytest.mark.asyncio
+async def test_transport_error():
+    def handler(request):
+        raise httpx.ConnectError("Hugging Face is unreachable", request=request)
+
+    batcher, client = make_batcher(handler, max_delay=0.05)
+    results = await query_all(batcher, [(API_URL, "drums"), (API_URL, "bass")])
+    await close(batcher, client)
+
+    assert all(isinstance(result, httpx.ConnectError) for result in results)
+
+
+@pytest.mark.asyncio
+async def test_too_many_queries_in_progress(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(main, "HF_ACQUIRE_TIMEOUT", 0.01)
+    sent = []
+
+    def handler(request):
+        sent.append(request)
+        return httpx.Response(200, content=b"audio")
+
+    saturated_errors = REGISTRY.get_sample_value("hf_errors_total", {"reason": "saturated"}) or 0
+    # No slot is ever free
+    batcher, client = make_batcher(handler, semaphore=asyncio.Semaphore(0))
+    with pytest.raises(Exception, match="Too many queries in progress"):
+        await batcher.query(API_URL, HEADERS, "drums")
+    await close(batcher, client)
+
+    assert sent == []
+    assert REGISTRY.get_sample_value("hf_errors_total", {"reason": "saturated"}) == saturated_errors + 1
+
+
+@pytest.mark.asyncio
+async def test_saturation_relative_to_capacity():
+    release = asyncio.Event()
+
+    async def handler(request):
+        await release.wait()
+        return httpx.Response(200, content=b"audio")
+
+    # 2 queries in progress out of 2 slots are above the saturation threshold
+    batcher, client = make_batcher(handler, capacity=2)
+    queries = asyncio.ensure_future(query_all(batcher, [(API_URL, "drums"), (OTHER_API_URL, "bass")]))
+    await asyncio.sleep(0.05)
+    assert REGISTRY.get_sample_value("hf_inflight") == 2
+    assert REGISTRY.get_sample_value("hf_saturated") == 1
+
+    release.set()
+    await queries
+    await close(batcher, client)
+
+    assert REGISTRY.get_sample_value("hf_inflight") == 0
+    assert REGISTRY.get_sample_value("hf_saturated") == 0
+
+
+@pytest.mark.asyncio
+async def test_batched_error_counted_once():
+    def handler(request):
+        return httpx.Response(401, json={"error": "Invalid credentials in Authorization header"})
+
+    upstream_errors = REGISTRY.get_sample_value("hf_errors_total", {"reason": "upstream"}) or 0
+    batcher, client = make_batcher(handler, max_delay=0.05)
+    await query_all(batcher, [(API_URL, "drums"), (API_URL, "bass"), (API_URL, "piano")])
+    await close(batcher, client)
+
+    assert REGISTRY.get_sample_value("hf_errors_total", {"reason": "upstream"}) == upstream_errors + 1
+
+
+@pytest.mark.asyncio
+async def test_stop_fails_pending_queries():
+    never = asyncio.Event()
+
+    async def handler(request):
+        await never.wait()
+
+    batcher, client = make_batcher(handler)
+    query = asyncio.ensure_future(batcher.query(API_URL, HEADERS, "drums"))
+    await asyncio.sleep(0.05)
+    await close(batcher, client)
+
+    with pytest.raises(Exception, match="shutting down"):
+        await query
+
+
+@pytest.fixture(name="sleeps")
+def sleeps_fixture(monkeypatch: pytest.MonkeyPatch):
+    sleeps = []
+    sleep = asyncio.sleep
+
+    async def fake_sleep(delay):
+        sleeps.append(delay)
+        await sleep(0)
+
+    monkeypatch.setattr(asyncio, "sleep", fake_sleep)
+    yield sleeps
+
+
+def loading_response(estimated_time):
+    return httpx.Response(
+        503, json={"error": "Model test is currently loading", "estimated_time": estimated_time}
+    )
+
+
+@pytest.mark.asyncio
+async def test_retry_while_loading(sleeps):
+    responses = [loading_response(42.0), loading_response(None), httpx.Response(200, content=audio_for("drums"))]
+
+    def handler(request):
+        return responses.pop(0)
+
+    batcher, client = make_batcher(handler)
+    result = await batcher.query(API_URL, HEADERS, "drums")
+    await close(batcher, client)
+
+    assert result == audio_for("drums")
+    # The estimated loading time is capped, without it the retry backs off exponentially
+    assert len(sleeps) == 2
+    assert HF_LOADING_MAX_DELAY <= sleeps[0] < HF_LOADING_MAX_DELAY + 1
+    assert 2 <= sleeps[1] < 3
+
+
+@pytest.mark.asyncio
+async def test_retry_while_loading_gives_up(sleeps):
+    sent = []
+
+    def handler(request):
+        sent.append(orjson.loads(request.content)["inputs"])
+        return loading_response("soon")
+
+    batcher, client = make_batcher(handler, max_delay=0.05)
+    results = await query_all(batcher, [(API_URL, "drums"), (API_URL, "bass")])
+    await close(batcher, client)
+
+    # The loading error is returned to every query without falling back to one request per input
+    assert all(b"currently loading" in result for result in results)
+    assert sent == [["drums", "bass"]] * (HF_LOADING_RETRIES + 1)
+    assert len(sleeps) == HF_LOADING_RETRIES
+
+
+@pytest.mark.asyncio
+async def test_gateway_error_not_retried(sleeps):
+    sent = []
+
+    def handler(request):
+        sent.append(request)
+        return httpx.Response(503, content=b"<html>Service Unavailable</html>")
+
+    batcher, client = make_batcher(handler)
+    with pytest.raises(Exception, match="HTTP 503"):
+        await batcher.query(API_URL, HEADERS, "drums")
+    await close(batcher, client)
+
+    assert len(sent) == 1
+    assert sleeps == []
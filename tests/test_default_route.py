@@ -13,3 +13,9 @@ def test_default_route(client: TestClient):
     response = client.get("/")
     # TODO: Why doesn't it return a 302?
     assert response.status_code == 200
+
+
+def test_metrics_route(client: TestClient):
+    response = client.get("/metrics/")
+    assert response.status_code == 200
+    assert "hf_inflight" in response.text
@@ -0,0 +1,120 @@
+import orjson
+import pytest
+from common_code.common.enums import FieldDescriptionType
+from common_code.tasks.models import TaskData
+import main
+from main import MyService, app
+
+API_URL = "https://api-inference.huggingface.co/models/test"
+
+
+class FakeBatcher:
+    def __init__(self, result_data):
+        self.result_data = result_data
+        self.queries = []
+
+    async def query(self, api_url, headers, text):
+        self.queries.append((api_url, headers["Authorization"], text))
+        return self.result_data
+
+
+def make_data(text, api_token="token", api_url=API_URL):
+    json_description = orjson.dumps({"api_token": api_token, "api_url": api_url})
+    return {
+        "json_description": TaskData(data=json_description, type=FieldDescriptionType.APPLICATION_JSON),
+        "input_text": TaskData(data=text.encode(), type=FieldDescriptionType.TEXT_PLAIN),
+    }
+
+
+@pytest.fixture(name="batcher")
+def batcher_fixture(monkeypatch: pytest.MonkeyPatch):
+    batcher = FakeBatcher(b"RIFF wav audio")
+    monkeypatch.setattr(app.state, "hf_batcher", batcher, raising=False)
+    yield batcher
+
+
+@pytest.fixture(name="transcodes")
+def transcodes_fixture(monkeypatch: pytest.MonkeyPatch):
+    transcodes = []
+
+    def fake_transcode_to_ogg(audio_data):
+        transcodes.append(audio_data)
+        return b"OggS " + audio_data
+
+    # Transcode in the default executor, the fake can't be sent to a spawned worker
+    monkeypatch.setattr(app.state, "transcode_pool", None, raising=False)
+    monkeypatch.setattr(main, "transcode_to_ogg", fake_transcode_to_ogg)
+    yield transcodes
+
+
+@pytest.mark.asyncio
+async def test_process_cache_hit(batcher: FakeBatcher, transcodes: list):
+    service = MyService()
+
+    first = await service._process(make_data("drums"))
+    second = await service._process(make_data("drums"))
+
+    assert first["result"].data == b"OggS RIFF wav audio"
+    assert second["result"].data == first["result"].data
+    # The hit skips both the Hugging Face query and the transcode
+    assert len(batcher.queries) == 1
+    assert len(transcodes) == 1
+
+
+@pytest.mark.asyncio
+async def test_process_cache_key(batcher: FakeBatcher, transcodes: list):
+    service = MyService()
+
+    await service._process(make_data("drums"))
+    await service._process(make_data("drums", api_token="other_token"))
+    await service._process(make_data("bass"))
+
+    # A cached audio is never served for another token or another input
+    assert batcher.queries == [
+        (API_URL, "Bearer token", "drums"),
+        (API_URL, "Bearer other_token", "drums"),
+        (API_URL, "Bearer token", "bass"),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_process_error_not_cached(batcher: FakeBatcher, transcodes: list):
+    service = MyService()
+    batcher.result_data = b'{"error": "Model test is currently loading"}'
+
+    for _ in range(2):
+        with pytest.raises(Exception, match="currently loading"):
+            await service._process(make_data("drums"))
+
+    assert len(batcher.queries) == 2
+    assert transcodes == []
+
+
+@pytest.mark.asyncio
+async def test_get_credentials_eviction(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(main, "CREDENTIALS_CACHE_SIZE", 2)
+    service = MyService()
+    descriptions = [
+        orjson.dumps({"api_token": api_token, "api_url": API_URL}) for api_token in ["a", "b", "c"]
+    ]
+
+    api_url, api_token, headers = service._get_credentials(descriptions[0])
+    assert (api_url, api_token, headers["Authorization"]) == (API_URL, "a", "Bearer a")
+    service._get_credentials(descriptions[1])
+    # Using the first description again makes the second one the least recently used
+    service._get_credentials(descriptions[0])
+    service._get_credentials(descriptions[2])
+
+    assert list(service._credentials_cache) == [descriptions[0], descriptions[2]]
+
+
+@pytest.mark.asyncio
+async def test_get_credentials_errors():
+    service = MyService()
+
+    with pytest.raises(Exception, match="json_description is invalid"):
+        service._get_credentials(b"not json")
+    with pytest.raises(Exception, match="api_url or api_token missing from json_description"):
+        service._get_credentials(orjson.dumps({"api_url": API_URL}))
+
+    assert len(service._credentials_cache) == 0